@@ -1,17 +1,41 @@
 import argparse
-import json
+import csv
+import functools
+import io
 import logging
+import os
 import re
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass
 from datetime import datetime
 from difflib import SequenceMatcher
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Tuple
 
-import pandas as pd
-import pdfplumber
+import orjson
+import pypdfium2 as pdfium
+import xlsxwriter
+from patiencediff import PatienceSequenceMatcher
 
 OUTPUT_FILE = "dataset.csv"
+SUMMARY_COLUMNS = ["Section", "Similarity", "Differences", "SF_Title", "Oakland_Title"]
+# Below this many matched section pairs, comparing serially beats pool startup
+PARALLEL_COMPARE_MIN_PAIRS = 256
+
+# Compiled once at import; these run against every extracted PDF line
+_WS_RE = re.compile(r"\s+")
+_PAGENUM_RE = re.compile(r"\b\d+\b\s*$")
+# Matches a section header line; exactly one group captures the section number.
+# Kept on stdlib re: the anchored alternation fails on the first character for
+# most lines, and re2's per-call overhead made it far slower on lines this short
+_HEADER_RE = re.compile(
+    r"^(?:"
+    r"Section\s+(\d+(?:\.\d+)*)"  # Starts with "Section" followed by number
+    r"|(\d+(?:\.\d+)*)(?:\s+|\s*—\s*)[A-Z]"  # Number, space or em dash, capital
+    r"|(\d{4})[A-Za-z]\.\d+\.\d+$"
+    r")"
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -34,11 +58,12 @@ argparser.add_argument(
     type=str,
     help="Supplemental building code documents, e.g. 2022 SF Plumbing",
 )
-args = argparser.parse_args()
 
 
 @dataclass
 class CodeSection:
+    __slots__ = ("number", "title", "content", "subsections", "page_number")
+
     number: str
     title: str
     content: str
@@ -48,91 +73,124 @@ class CodeSection:
 
 @dataclass
 class ParsedCode:
+    __slots__ = ("jurisdiction", "sections", "source_file", "parse_date")
+
     jurisdiction: str
     sections: List[CodeSection]
     source_file: str
     parse_date: datetime
 
 
+def _extract_page_texts(pdf_path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    """Extract (page number, text) for pages start..stop-1; runs in a worker process"""
+    # Pass the path, not a buffer or mmap: PDFium then reads the file natively on
+    # demand, whereas file-like input is read back through Python callbacks
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        texts = []
+        for i in range(start, min(stop, len(pdf))):
+            # Release each page's native handles as soon as its text is read so
+            # long documents don't accumulate parsed page trees
+            page = pdf[i]
+            try:
+                textpage = page.get_textpage()
+                try:
+                    texts.append((i + 1, textpage.get_text_range()))
+                finally:
+                    textpage.close()
+            finally:
+                page.close()
+        return texts
+    finally:
+        pdf.close()
+
+
 class BuildingCodeParser:
     def __init__(self):
         self.output_dir = Path("parsed_codes")
         self.output_dir.mkdir(exist_ok=True)
 
-    def clean_text(self, text: str) -> str:
+    @staticmethod
+    @functools.lru_cache(maxsize=8192)
+    def clean_text(text: str) -> str:
         """Clean extracted PDF text"""
+        # Cached: running headers and footers repeat on every page
         # Remove multiple spaces
-        text = re.sub(r"\s+", " ", text)
+        text = _WS_RE.sub(" ", text)
         # Remove page numbers
-        text = re.sub(r"\b\d+\b\s*$", "", text)
-        # Remove footer/header artifacts
-        text = re.sub(r"(?i)(chapter|section).*?\n", "", text)
+        text = _PAGENUM_RE.sub("", text)
         return text.strip()
 
-    def extract_section_number(self, text: str) -> Optional[str]:
-        """Extract section number from text"""
-        pattern = r"(?:Section\s+)?(\d+(?:\.\d+)*)"
-        match = re.search(pattern, text)
-
-        if match:
-            return match.group(1)
-        else:
-            return None
-
-    def is_section_header(self, text: str) -> bool:
-        """Determine if text is a section header"""
-        patterns = [
-            r"^\d+(?:\.\d+)*\s+[A-Z]",  # Starts with number followed by capital letter
-            r"^Section\s+\d+(?:\.\d+)*",  # Starts with "Section" followed by number
-            r"^\d+(?:\.\d+)*\s*—\s*[A-Z]",  # Number followed by em dash and capital letter
-            r"^\d{4}[A-Za-z]\.\d+\.\d+$",
+    def submit_pdf(
+        self, pdf_path: str, jurisdiction: str, executor: Executor
+    ) -> List[Future]:
+        """Queue text extraction for a PDF's page ranges on executor"""
+        logger.info(f"Parsing {jurisdiction} building code from {pdf_path}")
+        try:
+            # PDFium is not thread-safe, so only ever count pages from one thread
+            pdf = pdfium.PdfDocument(pdf_path)
+            try:
+                page_count = len(pdf)
+            finally:
+                pdf.close()
+        except Exception as e:
+            logger.error(f"Error parsing PDF {pdf_path}: {e}")
+            raise
+
+        # Contiguous page ranges, several per worker so stitching can start early
+        workers = os.cpu_count() or 1
+        chunk_size = max(1, -(-page_count // (workers * 4)))
+        return [
+            executor.submit(_extract_page_texts, pdf_path, start, start + chunk_size)
+            for start in range(0, page_count, chunk_size)
         ]
-        return any(re.match(pattern, text.strip()) for pattern in patterns)
 
-    def parse_pdf(self, pdf_path: str, jurisdiction: str) -> ParsedCode:
-        """Parse building code PDF and extract structured content"""
-        logger.info(f"Parsing {jurisdiction} building code from {pdf_path}")
+    def collect_pdf(
+        self, pdf_path: str, jurisdiction: str, page_futures: List[Future]
+    ) -> ParsedCode:
+        """Stitch sections together, in page order, from submit_pdf's futures"""
         sections = []
         current_section = None
-        current_text = []
+        current_text = io.StringIO()
 
         try:
-            with pdfplumber.open(pdf_path) as pdf:
-                for page in pdf.pages:
-                    text = page.extract_text()
-
-                    # Split text into lines
-                    lines = text.split("\n")
-
-                    for line in lines:
+            for future in page_futures:
+                for page_number, text in future.result():
+                    for line in text.splitlines():
+                        # Skip blank lines before paying for the regex cleanup
+                        if not line or line.isspace():
+                            continue
                         line = self.clean_text(line)
+                        if not line:
+                            continue
 
-                        if self.is_section_header(line):
+                        header = _HEADER_RE.match(line)
+                        if header:
                             # Save previous section if exists
                             if current_section:
-                                current_section.content = "\n".join(current_text)
+                                current_section.content = current_text.getvalue()
                                 sections.append(current_section)
 
                             # Start new section
-                            section_number = self.extract_section_number(line)
-                            if section_number:  # Only create section if number is found
-                                current_section = CodeSection(
-                                    number=section_number,
-                                    title=line,
-                                    content="",
-                                    subsections=[],
-                                    page_number=page.page_number,
-                                )
-                                current_text = []
+                            current_section = CodeSection(
+                                number=header[header.lastindex],
+                                title=line,
+                                content="",
+                                subsections=[],
+                                page_number=page_number,
+                            )
+                            current_text = io.StringIO()
                         elif (
                             current_section
                         ):  # Only append text if we have a current section
-                            current_text.append(line)
+                            if current_text.tell():
+                                current_text.write("\n")
+                            current_text.write(line)
 
-                # Add final section
-                if current_section:
-                    current_section.content = "\n".join(current_text)
-                    sections.append(current_section)
+            # Add final section
+            if current_section:
+                current_section.content = current_text.getvalue()
+                sections.append(current_section)
 
         except Exception as e:
             logger.error(f"Error parsing PDF {pdf_path}: {e}")
@@ -145,32 +203,81 @@ class BuildingCodeParser:
             parse_date=datetime.now(),
         )
 
+    def parse_pdf(self, pdf_path: str, jurisdiction: str) -> ParsedCode:
+        """Parse building code PDF and extract structured content"""
+        # Extract page text in worker processes, then stitch sections in order
+        with ProcessPoolExecutor() as executor:
+            page_futures = self.submit_pdf(pdf_path, jurisdiction, executor)
+            return self.collect_pdf(pdf_path, jurisdiction, page_futures)
+
+
+def _common_affix_lengths(a: List[str], b: List[str]) -> Tuple[int, int]:
+    """Lengths of the common prefix and (non-overlapping) common suffix of a and b"""
+    prefix = len(os.path.commonprefix([a, b]))
+    max_suffix = min(len(a), len(b)) - prefix
+    suffix = len(os.path.commonprefix([a[::-1][:max_suffix], b[::-1][:max_suffix]]))
+    return prefix, suffix
+
+
+def _compare_pair_worker(pair: Tuple[CodeSection, CodeSection]) -> Dict:
+    """Compare one (SF, Oakland) section pair; runs in a worker process"""
+    return CodeComparator.compare_sections(*pair)
+
 
 class CodeComparator:
     def __init__(self):
         self.parser = BuildingCodeParser()
 
-    def compare_sections(self, section1: CodeSection, section2: CodeSection) -> Dict:
+    @staticmethod
+    def compare_sections(section1: CodeSection, section2: CodeSection) -> Dict:
         """Compare two code sections and identify differences"""
-        # Calculate similarity ratio
-        similarity = SequenceMatcher(None, section1.content, section2.content).ratio()
-
         comparison = {
             "section_number": section1.number,
-            "similarity": similarity,
+            "similarity": 1.0,
             "sf_title": section1.title,
             "oakland_title": section2.title,
             "differences": [],
         }
 
-        # Compare content using difflib
-        s = SequenceMatcher(None, section1.content, section2.content)
+        # Identical sections need no diff at all
+        if section1.content == section2.content:
+            return comparison
+
+        # Measure similarity on words, not lines: each PDF wraps the same
+        # paragraph at different points, so line breaks say nothing about the text
+        a_words = section1.content.split()
+        b_words = section2.content.split()
+        if a_words == b_words:
+            return comparison
+        prefix, suffix = _common_affix_lengths(a_words, b_words)
+        s = SequenceMatcher(
+            None,
+            a_words[prefix : len(a_words) - suffix],
+            b_words[prefix : len(b_words) - suffix],
+        )
+        # Count the trimmed edges as matches so the ratio covers the full contents
+        matched = prefix + suffix + sum(size for _, _, size in s.get_matching_blocks())
+        comparison["similarity"] = 2.0 * matched / (len(a_words) + len(b_words))
+
+        # Diff hunks stay line by line; trim the common edges first so the diff
+        # only sees the edited middle
+        a = section1.content.splitlines()
+        b = section2.content.splitlines()
+        prefix, suffix = _common_affix_lengths(a, b)
+        a_mid = a[prefix : len(a) - suffix]
+        b_mid = b[prefix : len(b) - suffix]
+
+        # Patience diff anchors on lines unique to both sides, which is fast and
+        # gives readable hunks when sections are largely the same
+        s = PatienceSequenceMatcher(None, a_mid, b_mid)
+
+        # Compare content using patience diff
         for tag, i1, i2, j1, j2 in s.get_opcodes():
             if tag != "equal":
                 difference = {
                     "type": tag,
-                    "sf_text": section1.content[i1:i2],
-                    "oakland_text": section2.content[j1:j2],
+                    "sf_text": "\n".join(a_mid[i1:i2]),
+                    "oakland_text": "\n".join(b_mid[j1:j2]),
                     "location": {
                         "sf_page": section1.page_number,
                         "oakland_page": section2.page_number,
@@ -184,40 +291,60 @@ class CodeComparator:
         """Compare building codes between SF and Oakland"""
         comparisons = []
 
-        # Match sections by number and compare
-        for sf_section in sf_code.sections:
-            matching_section = next(
-                (s for s in oakland_code.sections if s.number == sf_section.number),
-                None,
-            )
-
-            if matching_section:
-                comparison = self.compare_sections(sf_section, matching_section)
-                comparisons.append(comparison)
+        # Index sections by number; keep the first Oakland section for a repeated number
+        oakland_by_num = {}
+        for s in oakland_code.sections:
+            oakland_by_num.setdefault(s.number, s)
+        sf_nums = {s.number for s in sf_code.sections}
+
+        # Compare matched pairs, in worker processes when there are enough of them
+        # to pay for the pool; both map()s keep the results in SF order
+        pairs = [
+            (s, oakland_by_num[s.number])
+            for s in sf_code.sections
+            if s.number in oakland_by_num
+        ]
+        pool = (
+            ProcessPoolExecutor()
+            if len(pairs) >= PARALLEL_COMPARE_MIN_PAIRS
+            else nullcontext()
+        )
+        with pool as executor:
+            if executor is None:
+                matched_comparisons = map(_compare_pair_worker, pairs)
             else:
-                comparisons.append(
-                    {
-                        "section_number": sf_section.number,
-                        "similarity": 0.0,
-                        "sf_title": sf_section.title,
-                        "oakland_title": "N/A",
-                        "differences": [
-                            {
-                                "type": "sf_only",
-                                "sf_text": sf_section.content,
-                                "oakland_text": "",
-                                "location": {
-                                    "sf_page": sf_section.page_number,
-                                    "oakland_page": None,
-                                },
-                            }
-                        ],
-                    }
+                matched_comparisons = executor.map(
+                    _compare_pair_worker, pairs, chunksize=32
                 )
 
+            # Match sections by number and compare
+            for sf_section in sf_code.sections:
+                if sf_section.number in oakland_by_num:
+                    comparisons.append(next(matched_comparisons))
+                else:
+                    comparisons.append(
+                        {
+                            "section_number": sf_section.number,
+                            "similarity": 0.0,
+                            "sf_title": sf_section.title,
+                            "oakland_title": "N/A",
+                            "differences": [
+                                {
+                                    "type": "sf_only",
+                                    "sf_text": sf_section.content,
+                                    "oakland_text": "",
+                                    "location": {
+                                        "sf_page": sf_section.page_number,
+                                        "oakland_page": None,
+                                    },
+                                }
+                            ],
+                        }
+                    )
+
         # Find sections unique to Oakland
         for oakland_section in oakland_code.sections:
-            if not any(s.number == oakland_section.number for s in sf_code.sections):
+            if oakland_section.number not in sf_nums:
                 comparisons.append(
                     {
                         "section_number": oakland_section.number,
@@ -241,20 +368,24 @@ class CodeComparator:
         return {"timestamp": datetime.now().isoformat(), "comparisons": comparisons}
 
 
-def generate_report(comparison_results: Dict) -> tuple[str, pd.DataFrame]:
-    """Generate human-readable report and summary DataFrame from comparison results"""
-    report = "Building Code Comparison: San Francisco vs Oakland\n"
-    report += f"Generated on: {comparison_results['timestamp']}\n\n"
+def generate_report(comparison_results: Dict) -> tuple[str, List[Dict]]:
+    """Generate human-readable report and summary rows from comparison results"""
+    parts = [
+        "Building Code Comparison: San Francisco vs Oakland\n",
+        f"Generated on: {comparison_results['timestamp']}\n\n",
+    ]
 
-    # Prepare data for DataFrame
+    # Prepare data for the summary sheet
     summary_data = []
 
     for comparison in comparison_results["comparisons"]:
-        report += f"\nSection {comparison['section_number']}:\n"
-        report += "=" * 40 + "\n"
-        report += f"Similarity: {comparison['similarity']:.1%}\n"
-        report += f"SF Title: {comparison['sf_title']}\n"
-        report += f"Oakland Title: {comparison['oakland_title']}\n\n"
+        parts.append(
+            f"\nSection {comparison['section_number']}:\n"
+            f"{'=' * 40}\n"
+            f"Similarity: {comparison['similarity']:.1%}\n"
+            f"SF Title: {comparison['sf_title']}\n"
+            f"Oakland Title: {comparison['oakland_title']}\n\n"
+        )
 
         # Add to summary data
         summary_data.append(
@@ -269,44 +400,80 @@ def generate_report(comparison_results: Dict) -> tuple[str, pd.DataFrame]:
 
         for diff in comparison["differences"]:
             if diff["type"] == "sf_only":
-                report += "Unique to San Francisco:\n"
-                report += f"Page {diff['location']['sf_page']}:\n"
-                report += diff["sf_text"] + "\n\n"
+                parts.append(
+                    "Unique to San Francisco:\n"
+                    f"Page {diff['location']['sf_page']}:\n"
+                    f"{diff['sf_text']}\n\n"
+                )
             elif diff["type"] == "oakland_only":
-                report += "Unique to Oakland:\n"
-                report += f"Page {diff['location']['oakland_page']}:\n"
-                report += diff["oakland_text"] + "\n\n"
+                parts.append(
+                    "Unique to Oakland:\n"
+                    f"Page {diff['location']['oakland_page']}:\n"
+                    f"{diff['oakland_text']}\n\n"
+                )
             else:
-                report += f"Difference Type: {diff['type']}\n"
-                report += f"SF Text (Page {diff['location']['sf_page']}):\n{diff['sf_text']}\n"
-                report += f"Oakland Text (Page {diff['location']['oakland_page']}):\n{diff['oakland_text']}\n\n"
+                parts.append(
+                    f"Difference Type: {diff['type']}\n"
+                    f"SF Text (Page {diff['location']['sf_page']}):\n{diff['sf_text']}\n"
+                    f"Oakland Text (Page {diff['location']['oakland_page']}):\n{diff['oakland_text']}\n\n"
+                )
 
-    return report, pd.DataFrame(summary_data)
+    return "".join(parts), summary_data
+
+
+def write_summary_xlsx(summary_data: List[Dict], path: str) -> None:
+    """Stream summary rows from generate_report straight into an Excel sheet"""
+    # constant_memory flushes each row to disk once the next one starts
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    try:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, SUMMARY_COLUMNS)
+        for row_number, row in enumerate(summary_data, 1):
+            worksheet.write_row(
+                row_number, 0, [row[column] for column in SUMMARY_COLUMNS]
+            )
+    finally:
+        workbook.close()
+
+
+def write_comparison_json(comparison_results: Dict, path: str) -> None:
+    """Serialize comparison results from compare_codes to an indented JSON file"""
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(comparison_results, option=orjson.OPT_INDENT_2))
 
 
 def main():
+    args = argparser.parse_args()
+
     # Initialize parser and comparator
     parser = BuildingCodeParser()
     comparator = CodeComparator()
 
+    # (path, jurisdiction, CSV location) for the base and each supplemental document
+    documents = [(args.base_document, "State", "state")] + [
+        (city, f"City {i}", f"city {i}") for i, city in enumerate(args.supplemental)
+    ]
+
     try:
-        with open(OUTPUT_FILE, "w") as f:
+        # Queue every document's page ranges on one shared pool first, then
+        # stitch each document in order while later ones are still extracting
+        with ProcessPoolExecutor() as executor:
+            pending = [
+                (path, jurisdiction, parser.submit_pdf(path, jurisdiction, executor))
+                for path, jurisdiction, _ in documents
+            ]
+            parsed_codes = [
+                parser.collect_pdf(path, jurisdiction, page_futures)
+                for path, jurisdiction, page_futures in pending
+            ]
+
+        with open(OUTPUT_FILE, "w", newline="", buffering=1 << 20) as f:
+            writer = csv.writer(f)
             # Write CSV header
-            f.write("location, section\n")
-
-            # Parse PDF for state
-            state_building_code = parser.parse_pdf(args.base_document, "State")
-            f.write(str(state_building_code))
-            for section in state_building_code.sections:
-                f.write(f"state\n{section.number}")
-
-            # Parse PDFs for cities
-            for i, city in enumerate(args.supplemental):
-                city_building_code = parser.parse_pdf(city, f"City {i}")
-                f.write(str(city))
-                for section in city_building_code.sections:
-                    f.write(f"city {i}\n{section.number}")
-        f.close()
+            writer.writerow(["location", "section"])
+
+            for (_, _, location), parsed_code in zip(documents, parsed_codes):
+                writer.writerows((location, s.number) for s in parsed_code.sections)
 
     except Exception as e:
         logger.error(f"Error during comparison: {e}")
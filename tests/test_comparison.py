@@ -0,0 +1,52 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from comparison import CodeComparator, CodeSection  # noqa: E402
+
+
+def make_section(content: str) -> CodeSection:
+    return CodeSection(
+        number="501.1",
+        title="501.1 Applicability",
+        content=content,
+        subsections=[],
+        page_number=1,
+    )
+
+
+def test_rewrapped_paragraph_is_fully_similar():
+    sf = make_section(
+        "Water heaters shall be installed\n"
+        "in accordance with the manufacturer\n"
+        "instructions and this code."
+    )
+    oakland = make_section(
+        "Water heaters shall be installed in accordance\n"
+        "with the manufacturer instructions and\n"
+        "this code."
+    )
+
+    comparison = CodeComparator.compare_sections(sf, oakland)
+
+    assert comparison["similarity"] == 1.0
+    assert comparison["differences"] == []
+
+
+def test_rewrapped_paragraph_with_edit_stays_similar():
+    sf = make_section(
+        "Water heaters shall be installed\n"
+        "in accordance with the manufacturer\n"
+        "instructions and this code."
+    )
+    oakland = make_section(
+        "Water heaters shall be installed in accordance\n"
+        "with the manufacturer installation instructions and\n"
+        "this code."
+    )
+
+    comparison = CodeComparator.compare_sections(sf, oakland)
+
+    assert 0.9 < comparison["similarity"] < 1.0
+    assert comparison["differences"]